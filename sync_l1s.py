@@ -1,123 +1,419 @@
 import os
+import sys
+import queue
+import logging
+import time
+import hashlib
+import random
 import asyncio
 import aiohttp
+import orjson
+from email.utils import parsedate_to_datetime
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import uvloop
+except ImportError:  # optional: fall back to the stock asyncio loop
+    uvloop = None
 
 ATTIO_BASE = "https://api.attio.com/v2"
 GLACIER_URL = "https://glacier-api.avax.network/v1/chains"
 HEADERS = {"Authorization": f"Bearer {os.environ['ATTIO_TOKEN']}"}
 ATTIO_OBJ = os.environ['ATTIO_OBJ']
 ATTIO_LIST_ID = os.environ['ATTIO_LIST_ID']
+RECORDS_URL = f"{ATTIO_BASE}/objects/{ATTIO_OBJ}/records"
+RECORDS_QUERY_URL = f"{RECORDS_URL}/query"
+LIST_ENTRIES_URL = f"{ATTIO_BASE}/lists/{ATTIO_LIST_ID}/entries"
+LIST_ENTRIES_QUERY_URL = f"{LIST_ENTRIES_URL}/query"
+UPSERT_PARAMS = {"matching_attribute": "chain_id"}
+LIST_ENTRY_FIELDS = {"parent_object": ATTIO_OBJ, "entry_values": {}}  # shared; never mutated
 CONCURRENCY_LIMIT = 20  # Adjust depending on API rate limits
+MAX_ATTEMPTS = 5
+RETRY_STATUSES = {408, 425, 429, 502, 503, 504}  # any other status is returned right away
+QUERY_PAGE_SIZE = 500
+QUERY_PREFETCH_PAGES = 4  # query pages requested concurrently
+CACHE_DIR = os.path.expanduser(os.environ.get("SYNC_CACHE_DIR", "~/.cache/sync_l1s"))
+DIGESTS_PATH = os.path.join(CACHE_DIR, "digests.json")
+LIST_IDS_PATH = os.path.join(CACHE_DIR, "list_ids.json")
+# Entries removed from the list by hand only show up on a full re-read
+LIST_FULL_REFRESH_AFTER = 7 * 24 * 3600
+GLACIER_BODY_PATH = os.path.join(CACHE_DIR, "glacier.json")
+GLACIER_ETAG_PATH = os.path.join(CACHE_DIR, "glacier.etag")
+
+rate_limited_until = 0.0  # loop.time() before which no request should be sent
+log = logging.getLogger("sync_l1s")
+
+def setup_logging():
+    """Log through a queue so concurrent tasks never block on stderr writes."""
+    q = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(q))
+    listener = QueueListener(q, logging.StreamHandler(sys.stderr))
+    listener.start()
+    return listener
+
+def retry_delay(headers, attempt):
+    """Seconds to wait before retrying, honoring Retry-After when Attio sends it."""
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    # No usable hint: exponential backoff with jitter so gathered tasks don't retry in lockstep
+    return 2 ** attempt + random.uniform(0, 1)
+
+async def request_json(session, method, url, idempotent=True, **kwargs):
+    """Send a request, retrying rate limits and transient failures.
+
+    Non-idempotent requests are only retried on 429, where Attio rejected the
+    request outright; after a lost response or 5xx a retry could apply it twice.
+
+    Returns (status, body) where body is the decoded JSON, or the raw text
+    when the response isn't JSON.
+    """
+    global rate_limited_until
+    if "json" in kwargs:
+        # Encode once to bytes; aiohttp's json= path would go through a str first
+        kwargs["data"] = orjson.dumps(kwargs.pop("json"))
+        kwargs["headers"] = {**kwargs.get("headers", {}), "Content-Type": "application/json"}
+    retry_statuses = RETRY_STATUSES if idempotent else {429}
+    loop = asyncio.get_running_loop()
+    for attempt in range(MAX_ATTEMPTS):
+        # Another task hit a 429: hold off until its backoff expires instead of piling on
+        pause = rate_limited_until - loop.time()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        wait = None
+        try:
+            async with session.request(method, url, **kwargs) as resp:
+                status = resp.status
+                raw = await resp.read()
+                if status in retry_statuses:
+                    wait = retry_delay(resp.headers, attempt)
+                if status == 429:
+                    rate_limited_until = max(rate_limited_until, loop.time() + wait)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if not idempotent or attempt == MAX_ATTEMPTS - 1:
+                raise
+            status, raw = None, str(e).encode()
+            wait = retry_delay({}, attempt)
+        if wait is None or attempt == MAX_ATTEMPTS - 1:
+            break
+        log.warning("⚠️ %s %s failed (%s), retrying in %.1fs…", method, url, status or raw.decode(), wait)
+        await asyncio.sleep(wait)
+    try:
+        return status, orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return status, raw.decode(errors="replace")
+
+def fingerprint(values):
+    """Stable digest of the values we would send to Attio for a chain."""
+    payload = orjson.dumps(values, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def write_atomic(path, data):
+    """Write bytes via a temp file + os.replace so a crash never leaves a torn cache."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
 
-sem = asyncio.Semaphore(CONCURRENCY_LIMIT)
+def load_digests():
+    """Return {chain_id: {"digest", "record_id"}} from the last run, if any."""
+    try:
+        with open(DIGESTS_PATH, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
 
-async def list_entry_exists(session, record_id):
-    """Return True if the record is already in the Attio list."""
-    async with session.get(
-        f"{ATTIO_BASE}/lists/{ATTIO_LIST_ID}/entries",
-        params={"parent_record_id": record_id},
+def save_digests(digests):
+    write_atomic(DIGESTS_PATH, orjson.dumps(digests))
+
+async def fetch_query_page(session, url, offset, **query):
+    status, data = await request_json(
+        session,
+        "POST",
+        url,
+        json={"limit": QUERY_PAGE_SIZE, "offset": offset, **query},
         headers=HEADERS,
-    ) as resp:
-        if resp.status != 200:
-            return False
-        data = await resp.json()
-        entries = data.get("data", [])
-        return any(e.get("parent_record_id") == record_id for e in entries)
-
-async def fetch_chains():
-    async with aiohttp.ClientSession() as session:
-        async with session.get(GLACIER_URL) as resp:
-            data = await resp.json()
-            return data.get("chains", [])
-
-async def upsert_and_add_to_list(session, chain):
-    async with sem:
-        for attempt in range(5):  # max 5 retries
-            try:
-                chain_name = chain.get("chainName")
-                is_testnet = chain.get("isTestnet")
-                if is_testnet:
-                    chain_name += " (Testnet)"
-
-                logo_url = chain.get("chainLogoUri")
-                    
-                values = {
-                    "chain_id": str(chain["chainId"]),
-                    "name": chain_name,
-                    "rpc": chain.get("rpcUrl"),
-                    "status": "Testnet" if is_testnet else "Mainnet",
-                    "logo_url": logo_url,
-                }
-
-                # Upsert the record
-                async with session.put(
-                    f"{ATTIO_BASE}/objects/{ATTIO_OBJ}/records",
-                    params={"matching_attribute": "chain_id"},
-                    json={"data": {"values": values}},
-                    headers=HEADERS,
-                ) as put_resp:
-                    if put_resp.status == 429:
-                        wait = 2 ** attempt
-                        print(f"⚠️ Rate limited on upsert for {chain['chainName']}, retrying in {wait}s…")
-                        await asyncio.sleep(wait)
-                        continue
-                    put_data = await put_resp.json()
-                    # print(put_data)
-                    parent_record_id = put_data.get("data", {}).get("id", {}).get("record_id")
-                    # print(parent_record_id)
-                    if not parent_record_id:
-                        print(f"⚠️ Failed to upsert: {chain.get('chainName')}")
-                        print(f"⚠️ Response: {await put_resp.text()}")
-                        print(values)
-                        print(chain)
-                        return
-
-                # Add to list only if it does not already exist
-                already_in_list = await list_entry_exists(session, parent_record_id)
-
-                if already_in_list:
-                    print(f"↳ already in list: {chain['chainName']}")
-                else:
-                    async with session.post(
-                        f"{ATTIO_BASE}/lists/{ATTIO_LIST_ID}/entries",
-                        json={
-                            "data": {
-                                "parent_record_id": parent_record_id,
-                                "parent_object": ATTIO_OBJ,
-                                "entry_values": {},
-                            }
-                        },
-                        headers=HEADERS,
-                    ) as post_resp:
-                        if post_resp.status == 429:
-                            wait = 2 ** attempt
-                            print(f"⚠️ Rate limited on list entry for {chain['chainName']}, retrying in {wait}s…")
-                            await asyncio.sleep(wait)
-                            continue
-                        elif post_resp.status == 409:
-                            print(f"↳ already in list: {chain['chainName']}")
-                        elif post_resp.status in [200, 201]:
-                            print(f"✅ added to list: {chain['chainName']}")
-                        else:
-                            text = await post_resp.text()
-                            print(f"❌ Error adding {chain['chainName']}: {post_resp.status} - {text}")
-                break  # Exit retry loop if all went well
-            except Exception as e:
-                print(f"❌ Unexpected error for {chain['chainName']}: {e}")
-                break
+    )
+    if status != 200:
+        raise RuntimeError(f"Attio query failed: {status} - {data}")
+    return data.get("data", [])
+
+async def iter_query_pages(session, url):
+    """Yield each page of rows from an Attio /query endpoint."""
+    offset = 0
+    while True:
+        # Attio doesn't report a total, so fetch a window of pages at once
+        # and stop at the first short page.
+        offsets = range(offset, offset + QUERY_PREFETCH_PAGES * QUERY_PAGE_SIZE, QUERY_PAGE_SIZE)
+        pages = await asyncio.gather(*[fetch_query_page(session, url, o) for o in offsets])
+        for page in pages:
+            yield page
+            if len(page) < QUERY_PAGE_SIZE:
+                return
+        offset += QUERY_PREFETCH_PAGES * QUERY_PAGE_SIZE
+
+def load_existing_ids():
+    """Return (list members, time of the last full read) saved by the last run."""
+    try:
+        with open(LIST_IDS_PATH, "rb") as f:
+            data = orjson.loads(f.read())
+        return set(data["ids"]), data["full_read_at"]
+    except (OSError, orjson.JSONDecodeError, KeyError, TypeError):
+        return None, None
+
+def save_existing_ids(existing_ids, full_read_at):
+    # full_read_at is carried over from the last full read, not the time of this save
+    write_atomic(LIST_IDS_PATH, orjson.dumps({"full_read_at": full_read_at, "ids": sorted(existing_ids)}))
+
+async def refresh_existing_ids(session, known):
+    """Add entries created since `known` was saved, newest first, until a known id shows up."""
+    offset = 0
+    while True:
+        page = await fetch_query_page(
+            session,
+            LIST_ENTRIES_QUERY_URL,
+            offset,
+            sorts=[{"attribute": "created_at", "direction": "desc"}],
+        )
+        ids = {rid for e in page if (rid := e.get("parent_record_id"))}
+        caught_up = not ids.isdisjoint(known)
+        known.update(ids)
+        if caught_up or len(page) < QUERY_PAGE_SIZE:
+            return known
+        offset += QUERY_PAGE_SIZE
+
+async def fetch_existing_ids(session):
+    """Return (parent record ids already in the Attio list, time of the last full read)."""
+    known, full_read_at = load_existing_ids()
+    if known and time.time() - full_read_at < LIST_FULL_REFRESH_AFTER:
+        return await refresh_existing_ids(session, known), full_read_at
+    full_read_at = time.time()
+    existing = set()
+    async for page in iter_query_pages(session, LIST_ENTRIES_QUERY_URL):
+        existing.update(rid for e in page if (rid := e.get("parent_record_id")))
+    return existing, full_read_at
+
+def attio_value(attr_values):
+    """Flatten Attio's per-attribute value list to the plain value we send."""
+    if not attr_values:
+        return None
+    v = attr_values[0]
+    if "option" in v:
+        return v["option"].get("title")
+    if "status" in v:
+        return v["status"].get("title")
+    return v.get("value")
+
+async def fetch_remote_records(session):
+    """Return {chain_id: {"record_id", "values"}} for records already in Attio."""
+    remote = {}
+    async for page in iter_query_pages(session, RECORDS_QUERY_URL):
+        for r in page:
+            values = {k: attio_value(v) for k, v in r.get("values", {}).items()}
+            if values.get("chain_id"):
+                remote[values["chain_id"]] = {"record_id": r["id"]["record_id"], "values": values}
+    return remote
+
+def load_glacier_cache():
+    """Return (etag, raw body) of the last Glacier response, if cached."""
+    try:
+        with open(GLACIER_ETAG_PATH) as f:
+            etag = f.read().strip()
+        with open(GLACIER_BODY_PATH, "rb") as f:
+            return etag, f.read()
+    except OSError:
+        return None, None
+
+def save_glacier_cache(etag, raw):
+    write_atomic(GLACIER_BODY_PATH, raw)
+    write_atomic(GLACIER_ETAG_PATH, etag.encode())
+
+async def fetch_chains(session):
+    # Conditional GET: a 304 lets us reuse the cached chain list without the download
+    etag, cached = load_glacier_cache()
+    headers = {"If-None-Match": etag} if etag else {}
+    async with session.get(GLACIER_URL, headers=headers) as resp:
+        if resp.status == 304:
+            log.info("↳ Glacier chain list not modified, using cache")
+            raw = cached
+        else:
+            resp.raise_for_status()
+            raw = await resp.read()
+            if resp.headers.get("ETag"):
+                save_glacier_cache(resp.headers["ETag"], raw)
+    return orjson.loads(raw).get("chains", [])
+
+def build_values(chain):
+    """Map a Glacier chain to the Attio attribute values we upsert."""
+    chain_name = chain.get("chainName")
+    is_testnet = chain.get("isTestnet")
+    if is_testnet:
+        chain_name += " (Testnet)"
+
+    return {
+        "chain_id": str(chain["chainId"]),
+        "name": chain_name,
+        "rpc": chain.get("rpcUrl"),
+        "status": "Testnet" if is_testnet else "Mainnet",
+        "logo_url": chain.get("chainLogoUri"),
+    }
+
+async def upsert_chain(session, chain, values, existing_ids, digests, remote):
+    """Upsert a chain record and return its record id, or None if skipped/failed."""
+    try:
+        # Skip chains that haven't changed since they were last synced and listed
+        digest = fingerprint(values)
+        cached = digests.get(values["chain_id"])
+        if cached and cached["digest"] == digest and cached["record_id"] in existing_ids:
+            log.info("↳ unchanged: %s", chain.get("chainName"))
+            return
+
+        # Only upsert when Attio's copy differs from what we would send
+        existing = remote.get(values["chain_id"])
+        if existing and all(existing["values"].get(k) == v for k, v in values.items()):
+            parent_record_id = existing["record_id"]
+        else:
+            # Upsert the record
+            status, put_data = await request_json(
+                session,
+                "PUT",
+                RECORDS_URL,
+                params=UPSERT_PARAMS,
+                json={"data": {"values": values}},
+                headers=HEADERS,
+            )
+            parent_record_id = None
+            if isinstance(put_data, dict):
+                parent_record_id = put_data.get("data", {}).get("id", {}).get("record_id")
+            if not parent_record_id:
+                log.warning("⚠️ Failed to upsert: %s", chain.get("chainName"))
+                log.warning("⚠️ Response: %s - %s", status, put_data)
+                log.warning("values=%s chain=%s", values, chain)
+                return
+
+        digests[values["chain_id"]] = {"digest": digest, "record_id": parent_record_id}
+        return parent_record_id
+    except Exception as e:
+        log.error("❌ Unexpected error for %s: %s", chain.get("chainName"), e)
+
+async def add_to_list(session, chain, parent_record_id, existing_ids):
+    try:
+        status, post_data = await request_json(
+            session,
+            "POST",
+            LIST_ENTRIES_URL,
+            json={"data": {"parent_record_id": parent_record_id, **LIST_ENTRY_FIELDS}},
+            headers=HEADERS,
+            # Creating an entry isn't idempotent; an unknown outcome is settled by next run's membership check
+            idempotent=False,
+        )
+        if status == 409:
+            existing_ids.add(parent_record_id)
+            log.info("↳ already in list: %s", chain.get("chainName"))
+        elif status in [200, 201]:
+            existing_ids.add(parent_record_id)
+            log.info("✅ added to list: %s", chain.get("chainName"))
+        else:
+            log.error("❌ Error adding %s: %s - %s", chain.get("chainName"), status, post_data)
+    except Exception as e:
+        log.error("❌ Unexpected error for %s: %s", chain.get("chainName"), e)
+
+async def run_bounded(fn, items, limit=CONCURRENCY_LIMIT):
+    """Await fn(item) for every item with at most `limit` running; results keep item order."""
+    results = [None] * len(items)
+    q = asyncio.Queue()
+    for i, item in enumerate(items):
+        q.put_nowait((i, item))
+
+    async def worker():
+        while not q.empty():
+            i, item = q.get_nowait()
+            results[i] = await fn(item)
+
+    await asyncio.gather(*[worker() for _ in range(min(limit, len(items)))])
+    return results
 
 async def main():
-    chains = await fetch_chains()
+    # One session for Glacier and Attio so keep-alive connections are reused.
+    # The connector is sized to the worker pool so idle sockets don't pile up.
+    # Auth stays per-request so the Attio token is never sent to Glacier.
+    connector = aiohttp.TCPConnector(
+        limit=CONCURRENCY_LIMIT,
+        limit_per_host=CONCURRENCY_LIMIT,
+        keepalive_timeout=75,
+        ttl_dns_cache=300,
+        enable_cleanup_closed=True,
+    )
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=60, connect=10, sock_read=30),
+    ) as session:
+        # With a warm digest cache, unchanged chains are skipped before the remote diff
+        # is ever consulted, so the full record scan only runs when the cache is cold.
+        digests = load_digests()
+
+        # The startup reads are independent, so run them together; a failure cancels the rest
+        async with asyncio.TaskGroup() as tg:
+            chains_task = tg.create_task(fetch_chains(session))
+            existing_task = tg.create_task(fetch_existing_ids(session))
+            remote_task = None if digests else tg.create_task(fetch_remote_records(session))
+        chains = chains_task.result()
+        existing_ids, list_full_read_at = existing_task.result()
+        remote = remote_task.result() if remote_task else {}
 
-    # Deduplicate chains by chainId to avoid processing duplicates
-    unique_chains_dict = {c.get("chainId"): c for c in chains}
-    unique_chains = list(unique_chains_dict.values())
+        # Deduplicate chains by chainId to avoid processing duplicates
+        unique_chains_dict = {c.get("chainId"): c for c in chains}
+        unique_chains = list(unique_chains_dict.values())
+
+        log.info("Found %d unique chains, syncing into Attio…", len(unique_chains))
+
+        # Build payloads up front so the workers below only wait on the network.
+        # A malformed Glacier entry is logged and skipped instead of aborting the run.
+        work = []
+        for c in unique_chains:
+            try:
+                work.append((c, build_values(c)))
+            except Exception as e:
+                log.error("❌ Unexpected error for %s: %s", c.get("chainName"), e)
 
-    print(f"Found {len(unique_chains)} unique chains, syncing into Attio…")
+        # Phase 1: upsert every chain, CONCURRENCY_LIMIT at a time
+        record_ids = await run_bounded(
+            lambda item: upsert_chain(session, *item, existing_ids, digests, remote),
+            work,
+        )
+        save_digests(digests)
 
-    async with aiohttp.ClientSession() as session:
-        tasks = [upsert_and_add_to_list(session, c) for c in unique_chains]
-        await asyncio.gather(*tasks)
+        # Phase 2: add the records that aren't in the list yet
+        to_add = {}
+        for (chain, _), record_id in zip(work, record_ids):
+            if not record_id:
+                continue
+            if record_id in existing_ids:
+                log.info("↳ already in list: %s", chain.get("chainName"))
+            else:
+                to_add.setdefault(record_id, chain)
+        await run_bounded(
+            lambda item: add_to_list(session, *item, existing_ids),
+            [(chain, record_id) for record_id, chain in to_add.items()],
+        )
+        save_existing_ids(existing_ids, list_full_read_at)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    listener = setup_logging()
+    try:
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
+    finally:
+        listener.stop()